@@ -1,56 +1,251 @@
 import boto3
-import json
+import csv
 import hashlib
 import hmac
+import json
 import logging
 import os
 import os.path as op
 from typing import Tuple
 
+from boto3.s3.transfer import TransferConfig
+from botocore.auth import S3SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.config import Config
+from botocore.credentials import Credentials
 from botocore.exceptions import ClientError
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from datetime import datetime, timedelta
+from functools import lru_cache
 from gzip import GzipFile
-from io import BytesIO
+from io import BytesIO, TextIOWrapper
+from itertools import islice
 from os import makedirs, getenv
+from queue import Queue
 from shutil import rmtree, copyfileobj
-from tempfile import mkdtemp
-from urllib.parse import urlparse, parse_qs
+from tempfile import mkdtemp, SpooledTemporaryFile
+from threading import Event, Lock
+from urllib.parse import urlparse, urlsplit, parse_qs, quote
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
+# multipart settings shared by upload and download
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+MAX_CONCURRENCY = 10
+
+# default number of threads for the *_many functions
+MAX_WORKERS = 16
+
+# default number of objects to download ahead in prefetch
+MAX_PREFETCH = 8
+
+# compressed uploads are buffered in memory up to this size, then on disk
+GZIP_SPOOL_SIZE = 32 * 1024 * 1024
+
+_TRANSFER_CFG = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD,
+                               multipart_chunksize=MULTIPART_CHUNKSIZE,
+                               max_concurrency=MAX_CONCURRENCY,
+                               use_threads=True)
+
+
+def _transfer_config(max_concurrency=None):
+    """ Get transfer config, only creating a new one if concurrency differs from the default """
+    if max_concurrency is None or max_concurrency == MAX_CONCURRENCY:
+        return _TRANSFER_CFG
+    return TransferConfig(multipart_threshold=MULTIPART_THRESHOLD,
+                          multipart_chunksize=MULTIPART_CHUNKSIZE,
+                          max_concurrency=max_concurrency,
+                          use_threads=True)
+
+
+# default config for s3 clients, with room in the connection pool for the
+# thread pools used by the *_many, find_parallel and prefetch functions
+_CLIENT_CONFIG = Config(max_pool_connections=50,
+                        retries={
+                            'mode': 'adaptive',
+                            'max_attempts': 10
+                        },
+                        tcp_keepalive=True)
+
+
+def set_client_config(**kwargs):
+    """
+    Update the config used for s3 clients created after this call
+
+    Keyword parameters are passed to botocore.config.Config, e.g.
+    max_pool_connections should be at least the max_workers used.
+    """
+    global _CLIENT_CONFIG
+    _CLIENT_CONFIG = _CLIENT_CONFIG.merge(Config(**kwargs))
+
+
+# presigned requests do not include a payload hash
+_UNSIGNED_PAYLOAD_CFG = Config(s3={'payload_signing_enabled': False})
+
+# marks the end of results produced in a background thread
+_DONE = object()
+
+
+class _GzipStream(GzipFile):
+    """ GzipFile that also closes the stream it wraps, e.g. an HTTP response body """
+    def close(self):
+        fileobj = self.fileobj
+        try:
+            super().close()
+        finally:
+            if fileobj is not None:
+                fileobj.close()
+
+
+def _decompress(key, fileobj):
+    """ Wrap fileobj to decompress it if key is gzipped """
+    if op.splitext(key)[1] == '.gz':
+        return _GzipStream(None, 'rb', fileobj=fileobj)
+    return fileobj
+
+
+def _map_ahead(fn, iterable, max_workers):
+    """ Like Executor.map, but only runs up to max_workers items ahead of the consumer """
+    items = iter(iterable)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = deque(
+            executor.submit(fn, i) for i in islice(items, max_workers))
+        try:
+            while futures:
+                future = futures.popleft()
+                for i in islice(items, 1):
+                    futures.append(executor.submit(fn, i))
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def _sql_string(value):
+    """ Quote value as an S3 Select SQL string literal """
+    return "'%s'" % value.replace("'", "''")
+
+
+def _sql_like(value, before='', after=''):
+    """ S3 Select LIKE clause matching value literally, with wildcards before and/or after """
+    for c in ('\\', '%', '_'):
+        value = value.replace(c, '\\' + c)
+    return "LIKE %s ESCAPE '\\'" % _sql_string(before + value + after)
+
+
+def _inventory_select_expression(keys,
+                                 prefix=None,
+                                 suffix=None,
+                                 start_date=None,
+                                 end_date=None,
+                                 is_latest=None,
+                                 key_contains=None,
+                                 datetime_key='LastModifiedDate'):
+    """ S3 Select SQL returning Bucket and Key of inventory rows matching the filters """
+
+    # inventory files have no header row, so columns are referenced by position
+    def col(name):
+        return 's._%s' % (keys.index(name) + 1)
+
+    key = col('Key')
+    where = []
+    if is_latest is not None and 'IsLatest' in keys:
+        where.append("%s <> 'false'" % col('IsLatest'))
+    for part in key_contains or []:
+        where.append('%s %s' % (key, _sql_like(part, '%', '%')))
+    if prefix:
+        where.append('%s %s' % (key, _sql_like(prefix, after='%')))
+    if suffix:
+        where.append('%s %s' % (key, _sql_like(suffix, before='%')))
+    # ISO 8601 dates sort the same as strings
+    if start_date:
+        where.append(
+            'SUBSTRING(%s, 1, 10) > %s' %
+            (col(datetime_key), _sql_string(start_date.isoformat()[:10])))
+    if end_date:
+        where.append(
+            'SUBSTRING(%s, 1, 10) < %s' %
+            (col(datetime_key), _sql_string(end_date.isoformat()[:10])))
+
+    sql = 'SELECT %s, %s FROM S3Object s' % (col('Bucket'), key)
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    return sql
+
+
+def _read_ahead(iterable):
+    """ Iterate in a background thread, fetching the next item while the current one is consumed """
+    it = iter(iterable)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(next, it, _DONE)
+        while True:
+            item = future.result()
+            if item is _DONE:
+                return
+            future = executor.submit(next, it, _DONE)
+            yield item
+
 
 class s3(object):
-    def __init__(self, session=None, requester_pays=False):
+    def __init__(self, session=None, requester_pays=False, config=None):
+        """
+        :param session: boto3 session used to create the client (default session if None)
+        :param requester_pays: Make requests as requester pays
+        :param config: botocore Config merged over the default client config
+        """
         self.requester_pays = requester_pays
-        if session is None:
-            self.s3 = boto3.client('s3')
-        else:
-            self.s3 = session.client('s3')
+        self.session = session
+        self.config = config
+        self._client = None
+        self._lock = Lock()
+
+    @property
+    def s3(self):
+        """ boto3 S3 client, created on first use """
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    config = _CLIENT_CONFIG
+                    if self.config is not None:
+                        config = config.merge(self.config)
+                    session = self.session or boto3
+                    self._client = session.client('s3', config=config)
+        return self._client
+
+    @s3.setter
+    def s3(self, client):
+        self._client = client
 
     @classmethod
     def urlparse(cls, url):
         """ Split S3 URL into bucket, key, filename, query_params """
-        _url = deepcopy(url)
-
         if url.startswith("https"):
-            _url = cls.https_to_s3(url)
+            url = cls.https_to_s3(url)
 
         if not url.startswith("s3://"):
-            raise Exception(f"Invalid S3 url {_url}")
+            raise Exception(f"Invalid S3 url {url}")
 
-        parsed = urlparse(_url)
-        query_params = parse_qs(parsed.query or "")
+        path, _, query = url[5:].partition("?")
+        bucket, _, key = path.partition("/")
+        query_params = parse_qs(query) if query else {}
 
         # now fix the "list-of-1" to be a straight string
-        for key in query_params:
-            if len(query_params[key]) == 1:
-                query_params[key] = query_params[key][0]
+        for k in query_params:
+            if len(query_params[k]) == 1:
+                query_params[k] = query_params[k][0]
 
         return {
-            "bucket": parsed.netloc,
-            "key": parsed.path.removeprefix("/"),
-            "filename": os.path.basename(parsed.path),
+            "bucket": bucket,
+            "key": key,
+            "filename": key.rpartition("/")[2],
             "parameters": query_params,
         }
 
@@ -89,6 +284,48 @@ class s3(object):
                 raise
             return False
 
+    def exists_many(self, urls):
+        """
+        Check if multiple URLs exist on S3, listing the common prefix of the keys
+        in each bucket rather than making a request per URL. Listing needs the
+        s3:ListBucket permission on each bucket rather than s3:GetObject
+
+        :param urls: URLs to check
+        :return: Dictionary of url to True if it exists, in the same order as urls
+        """
+        groups = {}
+        for url in urls:
+            parts = self.urlparse(url)
+            groups.setdefault(parts['bucket'], {})[url] = parts['key']
+
+        results = {}
+        for bucket, keys in groups.items():
+            prefix = op.commonprefix(list(keys.values()))
+            if not prefix:
+                # fall back to checking each URL rather than listing the bucket
+                for url in keys:
+                    results[url] = self.exists(url)
+                continue
+
+            # keys are listed in order, so start just before the first key
+            # checked and stop after the last
+            first = min(keys.values())
+            last = max(keys.values())
+            kwargs = {'Bucket': bucket, 'Prefix': prefix}
+            if first[:-1]:
+                # sorts before every key checked, so none are skipped
+                kwargs['StartAfter'] = first[:-1]
+            found = set()
+            for resp in self._list_pages(**kwargs):
+                contents = resp.get('Contents', ())
+                found.update(obj['Key'] for obj in contents)
+                if contents and contents[-1]['Key'] >= last:
+                    break
+            for url, key in keys.items():
+                results[url] = key in found
+
+        return {url: results[url] for url in urls}
+
     def get_bucket_region(self, bucket_name):
         region = self.s3.get_bucket_location(
             Bucket=bucket_name)['LocationConstraint']
@@ -96,18 +333,52 @@ class s3(object):
         # https://github.com/aws/aws-cli/issues/3864
         return region if region else 'us-east-1'
 
-    def upload(self, filename, url, public=False, extra={}, http_url=False):
-        """ Upload object to S3 uri (bucket + prefix), keeping same base filename """
+    def upload(self,
+               filename,
+               url,
+               public=False,
+               extra={},
+               http_url=False,
+               max_concurrency=None,
+               gzip_if=None):
+        """ Upload object to S3 uri (bucket + prefix), keeping same base filename
+
+        :param max_concurrency: Number of threads used for multipart uploads
+        :param gzip_if: Function of filename returning True if the file should be
+            gzip compressed before upload, with ".gz" added to the key
+            (e.g. lambda f: f.endswith(('.json', '.csv', '.txt')))
+        """
         logger.debug("Uploading %s to %s" % (filename, url))
         parts = self.urlparse(url)
-        url_out = 's3://%s' % op.join(parts['bucket'], parts['key'])
+        key = parts['key']
+        extra = dict(extra)
         if public:
             extra['ACL'] = 'public-read'
-        with open(filename, 'rb') as data:
-            self.s3.upload_fileobj(data,
-                                   parts['bucket'],
-                                   parts['key'],
-                                   ExtraArgs=extra)
+        if gzip_if and gzip_if(filename):
+            if not key.endswith('.gz'):
+                key += '.gz'
+            extra.setdefault('ContentEncoding', 'gzip')
+            with SpooledTemporaryFile(max_size=GZIP_SPOOL_SIZE) as buf:
+                with open(filename, 'rb') as src:
+                    with GzipFile(fileobj=buf, mode='wb',
+                                  compresslevel=6) as gz:
+                        copyfileobj(src, gz, 1024 * 1024)
+                buf.seek(0)
+                self.s3.upload_fileobj(
+                    buf,
+                    parts['bucket'],
+                    key,
+                    ExtraArgs=extra,
+                    Config=_transfer_config(max_concurrency))
+        else:
+            # let the transfer manager open the file, so multipart threads can
+            # read their parts directly
+            self.s3.upload_file(filename,
+                                parts['bucket'],
+                                key,
+                                ExtraArgs=extra,
+                                Config=_transfer_config(max_concurrency))
+        url_out = f"s3://{parts['bucket']}/{key}"
         if http_url:
             return self.s3_to_https(url_out,
                                     self.get_bucket_region(parts['bucket']))
@@ -167,7 +438,7 @@ class s3(object):
 
         return response
 
-    def download(self, uri, path='', **kwargs):
+    def download(self, uri, path='', max_concurrency=None, **kwargs):
         """
         Download object from S3
 
@@ -175,6 +446,7 @@ class s3(object):
 
         :param uri: URI of object to download
         :param path: Output path
+        :param max_concurrency: Number of threads used for multipart downloads
         """
         s3_uri = self.urlparse(uri)
         fout = op.join(path, s3_uri['filename'])
@@ -194,9 +466,27 @@ class s3(object):
         self.s3.download_file(s3_uri["bucket"],
                               s3_uri["key"],
                               fout,
-                              ExtraArgs=extra_args)
+                              ExtraArgs=extra_args,
+                              Config=_transfer_config(max_concurrency))
         return fout
 
+    def download_many(self, uris, path='', max_workers=MAX_WORKERS, **kwargs):
+        """
+        Download multiple objects from S3 concurrently
+
+        Additional keyword parameters will be passed to download.
+
+        :param uris: URIs of objects to download
+        :param path: Output path
+        :param max_workers: Number of objects to download at once
+        :return: List of output filenames, in the same order as uris
+        """
+        def _download(uri):
+            return self.download(uri, path, **kwargs)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(_download, uris))
+
     def download_with_metadata(self,
                                uri,
                                path='',
@@ -244,21 +534,64 @@ class s3(object):
 
     def read(self, url):
         """ Read object from s3 """
+        with self.stream(url) as f:
+            return f.read().decode('utf-8')
+
+    def read_many(self, urls, max_workers=MAX_WORKERS):
+        """ Read multiple objects from s3 concurrently, in the same order as urls """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self.read, urls))
+
+    def stream(self, url):
+        """ Open object from s3 as a binary stream, decompressing if gzipped """
         parts = self.urlparse(url)
-        kwargs = {}
-        if self.requester_pays:
-            kwargs["RequestPayer"] = "requester"
-        response = self.get_object(parts['bucket'],
-                                   parts['key'],
-                                   extra_args=kwargs)
-        body = response['Body'].read()
-        if op.splitext(parts['key'])[1] == '.gz':
-            body = GzipFile(None, 'rb', fileobj=BytesIO(body)).read()
-        return body.decode('utf-8')
+        response = self.get_object(parts['bucket'], parts['key'])
+        return _decompress(parts['key'], response['Body'])
+
+    def prefetch(self, urls, max_workers=MAX_PREFETCH):
+        """
+        Generate (url, stream) for objects from s3, downloading the next
+        max_workers objects in the background while the current one is consumed
+
+        :param urls: URLs of objects to read
+        :param max_workers: Number of objects to download ahead
+        """
+        def _fetch(url):
+            parts = self.urlparse(url)
+            body = self.get_object(parts['bucket'],
+                                   parts['key'])['Body'].read()
+            return _decompress(parts['key'], BytesIO(body))
+
+        yield from _map_ahead(lambda url: (url, _fetch(url)), urls,
+                              max_workers)
+
+    def read_csv(self, url, fileobj=None, **kwargs):
+        """
+        Generate rows of a CSV object from s3 without reading it all into memory
+
+        Additional keyword parameters will be passed to csv.reader.
+
+        :param url: URL of the object
+        :param fileobj: Binary stream of the object if already opened (e.g. from prefetch)
+        """
+        with TextIOWrapper(fileobj or self.stream(url),
+                           encoding='utf-8',
+                           newline='') as f:
+            yield from csv.reader(f, **kwargs)
+
+    def iter_lines(self, url):
+        """ Generate lines of a text object from s3 without reading it all into memory """
+        with TextIOWrapper(self.stream(url), encoding='utf-8') as f:
+            for line in f:
+                yield line.rstrip('\r\n')
 
     def read_json(self, url):
-        """ Download object from S3 as JSON """
-        return json.loads(self.read(url))
+        """ Download object from S3 as JSON, parsed with orjson if it is installed """
+        with self.stream(url) as f:
+            body = f.read()
+        if orjson is not None:
+            return orjson.loads(body)
+        return json.loads(body)
 
     def delete(self, url):
         """ Remove object from S3 """
@@ -268,44 +601,124 @@ class s3(object):
         return response
 
     # function derived from https://alexwlchan.net/2018/01/listing-s3-keys-redux/
-    def find(self, url, suffix=''):
+    def find(self, url, suffix='', read_ahead=False, start_after=None):
         """
         Generate objects in an S3 bucket.
         :param url: The beginning part of the URL to match (bucket + optional prefix)
         :param suffix: Only fetch objects whose keys end with this suffix.
+        :param read_ahead: Fetch the next page of results in a background thread
+            while the current page is being consumed.
+        :param start_after: Only fetch objects whose keys sort after this key,
+            skipping them in the S3 API rather than after listing.
         """
         parts = self.urlparse(url)
-        kwargs = {'Bucket': parts['bucket']}
+        yield from self._find(parts['bucket'],
+                              parts['key'],
+                              suffix=suffix,
+                              read_ahead=read_ahead,
+                              start_after=start_after)
+
+    def find_parallel(self,
+                      url,
+                      suffix='',
+                      shards=None,
+                      max_workers=MAX_WORKERS):
+        """
+        Generate objects in an S3 bucket, listing several prefixes concurrently.
 
-        # If the prefix is a single string (not a tuple of strings), we can
-        # do the filtering directly in the S3 API.
-        if isinstance(parts['key'], str):
-            kwargs['Prefix'] = parts['key']
+        Objects are not generated in key order.
+        :param url: The beginning part of the URL to match (bucket + optional prefix)
+        :param suffix: Only fetch objects whose keys end with this suffix.
+        :param shards: Strings appended to the URL prefix, each listed in its own
+            thread (e.g. the hex digits for hash-prefixed keys). Keys that do not
+            start with one of the shards are not returned. Defaults to the
+            "directories" directly under the prefix.
+        :param max_workers: Number of prefixes to list at once
+        """
+        parts = self.urlparse(url)
+        bucket = parts['bucket']
+
+        if shards is None:
+            # objects directly under the prefix are returned here, everything
+            # else is grouped into common prefixes that are listed concurrently
+            prefixes = []
+            for resp in self._list_pages(Bucket=bucket,
+                                         Prefix=parts['key'],
+                                         Delimiter='/'):
+                for obj in resp.get('Contents', []):
+                    if obj['Key'].endswith(suffix):
+                        yield f"s3://{bucket}/{obj['Key']}"
+                prefixes += [
+                    p['Prefix'] for p in resp.get('CommonPrefixes', [])
+                ]
+        else:
+            prefixes = [parts['key'] + shard for shard in shards]
 
-        if self.requester_pays:
-            kwargs["RequestPayer"] = "requester"
+        results = Queue()
+        stop = Event()
 
-        while True:
+        def _find(prefix):
+            try:
+                for _url in self._find(bucket, prefix, suffix=suffix):
+                    if stop.is_set():
+                        return
+                    results.put(_url)
+            finally:
+                results.put(_DONE)
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            futures = [executor.submit(_find, p) for p in prefixes]
+            remaining = len(futures)
+            while remaining:
+                item = results.get()
+                if item is _DONE:
+                    remaining -= 1
+                else:
+                    yield item
+            # raise any errors from the listing threads
+            for future in futures:
+                future.result()
+        finally:
+            stop.set()
+            executor.shutdown(cancel_futures=True)
+
+    def _find(self,
+              bucket,
+              prefix,
+              suffix='',
+              read_ahead=False,
+              start_after=None):
+        """ Generate URLs of objects in bucket with prefix and suffix """
+        kwargs = {'Bucket': bucket, 'Prefix': prefix}
+        if start_after:
+            kwargs['StartAfter'] = start_after
+
+        pages = self._list_pages(**kwargs)
+        if read_ahead:
+            pages = _read_ahead(pages)
+
+        for resp in pages:
             # The S3 API response is a large blob of metadata.
             # 'Contents' contains information about the listed objects.
-            resp = self.s3.list_objects_v2(**kwargs)
-            try:
-                contents = resp['Contents']
-            except KeyError:
-                return
-
-            for obj in contents:
+            # S3 only returns keys with the prefix, so only the suffix
+            # needs to be checked
+            for obj in resp.get('Contents', ()):
                 key = obj['Key']
-                if key.startswith(parts['key']) and key.endswith(suffix):
-                    yield f"s3://{parts['bucket']}/{obj['Key']}"
+                if not suffix or key.endswith(suffix):
+                    yield f"s3://{bucket}/{key}"
 
-            # The S3 API is paginated, returning up to 1000 keys at a time.
-            # Pass the continuation token into the next response, until we
-            # reach the final page (when this field is missing).
-            try:
-                kwargs['ContinuationToken'] = resp['NextContinuationToken']
-            except KeyError:
-                break
+    def _list_pages(self, **kwargs):
+        """ Generate list_objects_v2 responses """
+        if self.requester_pays:
+            kwargs["RequestPayer"] = "requester"
+
+        # The S3 API is paginated, returning up to 1000 keys at a time.
+        # The paginator passes the continuation token into the next request
+        # until the final page is reached.
+        paginator = self.s3.get_paginator('list_objects_v2')
+        yield from paginator.paginate(**kwargs,
+                                      PaginationConfig={'PageSize': 1000})
 
     def read_inventory_file(self,
                             fname,
@@ -316,62 +729,114 @@ class s3(object):
                             end_date=None,
                             is_latest=None,
                             key_contains=None,
-                            datetime_key='LastModifiedDate'):
+                            datetime_key='LastModifiedDate',
+                            fileobj=None):
         logger.debug('Reading inventory file %s' % (fname))
 
-        inv = [{
-            keys[i]: v
-            for i, v in enumerate(line.replace('"', '').split(','))
-        } for line in self.read(fname).split('\n')]
-
-        def fvalid(info):
-            return True if 'Key' in info and 'Bucket' in info else False
-
-        def fprefix(info):
-            return True if info['Key'][:len(prefix)] == prefix else False
-
-        def fsuffix(info):
-            return True if info['Key'].endswith(suffix) else False
-
-        def fstartdate(info):
-            dt = datetime.strptime(info[datetime_key],
-                                   "%Y-%m-%dT%H:%M:%S.%fZ").date()
-            return True if dt > start_date else False
-
-        def fenddate(info):
-            dt = datetime.strptime(info[datetime_key],
-                                   "%Y-%m-%dT%H:%M:%S.%fZ").date()
-            return True if dt < end_date else False
-
-        def islatest(info):
-            latest = info.get("IsLatest")
-            if latest:
-                return latest not in ("false", False)
-            return True
+        if 'Key' not in keys or 'Bucket' not in keys:
+            return
+
+        # filter on positions in the schema rather than building a dict
+        # for every row
+        key_idx = keys.index('Key')
+        bucket_idx = keys.index('Bucket')
+        ncols = max(key_idx, bucket_idx) + 1
+        date_idx = None
+        if start_date or end_date:
+            date_idx = keys.index(datetime_key)
+            ncols = max(ncols, date_idx + 1)
+        latest_idx = None
+        if is_latest is not None and 'IsLatest' in keys:
+            latest_idx = keys.index('IsLatest')
+            ncols = max(ncols, latest_idx + 1)
+
+        # ISO 8601 dates sort the same as strings, so compare the date part
+        # of the timestamp without parsing it
+        start = start_date.isoformat()[:10] if start_date else None
+        end = end_date.isoformat()[:10] if end_date else None
+
+        for row in self.read_csv(fname, fileobj=fileobj):
+            if len(row) < ncols:
+                continue
+            key = row[key_idx]
+            if latest_idx is not None and row[latest_idx] == 'false':
+                continue
+            if key_contains and not all(part in key for part in key_contains):
+                continue
+            if prefix and not key.startswith(prefix):
+                continue
+            if suffix and not key.endswith(suffix):
+                continue
+            if start and row[date_idx][:10] <= start:
+                continue
+            if end and row[date_idx][:10] >= end:
+                continue
+            yield f"s3://{row[bucket_idx]}/{key}"
+
+    def select_inventory_file(self, fname, keys, **kwargs):
+        """
+        Generate URLs of objects in an inventory file matching the filters,
+        filtering with S3 Select so only matching rows are downloaded
 
-        def fcontains(info):
-            for part in key_contains:
-                if part not in info["Key"]:
-                    return False
-            return True
+        Keyword parameters are the filters of read_inventory_file. Note that
+        S3 Select is only available to AWS accounts that have used it before.
+        """
+        logger.debug('Selecting from inventory file %s' % (fname))
+        parts = self.urlparse(fname)
+        compression = 'GZIP' if parts['key'].endswith('.gz') else 'NONE'
+        resp = self.s3.select_object_content(
+            Bucket=parts['bucket'],
+            Key=parts['key'],
+            Expression=_inventory_select_expression(keys, **kwargs),
+            ExpressionType='SQL',
+            InputSerialization={
+                'CSV': {
+                    'FileHeaderInfo': 'NONE'
+                },
+                'CompressionType': compression
+            },
+            OutputSerialization={'CSV': {}})
+
+        # records are split across events at arbitrary points, so rejoin
+        # them into lines before parsing
+        def _lines():
+            pending = b''
+            for event in resp['Payload']:
+                if 'Records' in event:
+                    pending += event['Records']['Payload']
+                    lines = pending.split(b'\n')
+                    pending = lines.pop()
+                    yield from lines
+            yield pending
+
+        for bucket, key in csv.reader(
+                line.decode('utf-8') for line in _lines() if line):
+            yield f"s3://{bucket}/{key}"
+
+    def latest_inventory_select(self, url, **kwargs):
+        """
+        Return generator function for objects in Bucket matching the filters
+        (see latest_inventory), using S3 Select on each inventory file
+        """
+        manifest_age_days = kwargs.pop("manifest_age_days", 1)
+        max_workers = kwargs.pop("max_workers", MAX_PREFETCH)
+        manifest = self.latest_inventory_manifest(url, manifest_age_days)
 
-        inv = filter(fvalid, inv)
+        if manifest:
+            keys = [
+                str(key).strip() for key in manifest['fileSchema'].split(',')
+            ]
 
-        if is_latest is not None:
-            inv - filter(islatest, inv)
-        if key_contains:
-            inv = filter(fcontains, inv)
-        if prefix:
-            inv = filter(fprefix, inv)
-        if suffix:
-            inv = filter(fsuffix, inv)
-        if start_date:
-            inv = filter(fstartdate, inv)
-        if end_date:
-            inv = filter(fenddate, inv)
+            # run the selects for the next inventory files while the results
+            # of the current one are consumed
+            def _select(fname):
+                return list(self.select_inventory_file(fname, keys, **kwargs))
 
-        for i in inv:
-            yield 's3://%s/%s' % (i['Bucket'], i['Key'])
+            files = self.latest_inventory_files(url, manifest)
+            for i, results in enumerate(_map_ahead(_select, files,
+                                                   max_workers)):
+                logger.info('Selected from inventory file %s' % (i + 1))
+                yield from results
 
     def latest_inventory_manifest(self, url, manifest_age_days=1):
         """ Get latest inventory manifest file """
@@ -379,9 +844,9 @@ class s3(object):
         # get latest manifest file
         today = datetime.now()
         manifest_url = None
+        prefix = parts['key'].rstrip('/') + '/' if parts['key'] else ''
         for dt in [today - timedelta(x) for x in range(manifest_age_days)]:
-            _key = op.join(parts['key'], dt.strftime('%Y-%m-%d'))
-            _url = 's3://%s/%s' % (parts['bucket'], _key)
+            _url = f"s3://{parts['bucket']}/{prefix}{dt:%Y-%m-%d}"
             manifests = [k for k in self.find(_url, suffix='manifest.json')]
             if len(manifests) == 1:
                 manifest_url = manifests[0]
@@ -404,12 +869,13 @@ class s3(object):
                         (url, numfiles))
 
             for f in files:
-                _url = 's3://%s/%s' % (bucket, f['key'])
+                _url = f"s3://{bucket}/{f['key']}"
                 yield _url
 
     def latest_inventory(self, url, **kwargs):
         """ Return generator function for objects in Bucket with suffix (all files if suffix=None) """
         manifest_age_days = kwargs.pop("manifest_age_days", 1)
+        max_workers = kwargs.pop("max_workers", MAX_PREFETCH)
         manifest = self.latest_inventory_manifest(url, manifest_age_days)
 
         # read through latest manifest looking for matches
@@ -419,13 +885,89 @@ class s3(object):
                 str(key).strip() for key in manifest['fileSchema'].split(',')
             ]
 
-            for i, url in enumerate(self.latest_inventory_files(url,
-                                                                manifest)):
+            # download the next inventory files while the current one is parsed
+            files = self.prefetch(self.latest_inventory_files(url, manifest),
+                                  max_workers=max_workers)
+            for i, (url, f) in enumerate(files):
                 logger.info('Reading inventory file %s' % (i + 1))
-                results = self.read_inventory_file(url, keys, **kwargs)
+                results = self.read_inventory_file(url,
+                                                   keys,
+                                                   fileobj=f,
+                                                   **kwargs)
                 yield from results
 
 
+@lru_cache(maxsize=32)
+def _hmac_template(key):
+    """ HMAC object for key, copied for each message to skip re-keying """
+    return hmac.new(key, None, hashlib.sha256)
+
+
+# Key derivation functions. See:
+# http://docs.aws.amazon.com/general/latest/gr/signature-v4-examples.html#signature-v4-examples-python
+def sign(key, msg, hex=False):
+    h = _hmac_template(key).copy()
+    h.update(msg.encode('utf-8'))
+    return h.hexdigest() if hex else h.digest()
+
+
+@lru_cache(maxsize=8)
+def getSignatureKey(key, dateStamp, regionName, serviceName):
+    """ Derive the signing key, which only changes once a day """
+    kDate = sign(('AWS4' + key).encode('utf-8'), dateStamp)
+    kRegion = sign(kDate, regionName)
+    kService = sign(kRegion, serviceName)
+    kSigning = sign(kService, 'aws4_request')
+    return kSigning
+
+
+# headers signed when no optional headers are set
+_DEFAULT_SIGNED_HEADERS = 'host;x-amz-content-sha256;x-amz-date'
+_DEFAULT_HEADER_NAMES = set(_DEFAULT_SIGNED_HEADERS.split(';'))
+
+
+class _S3SigV4Auth(S3SigV4Auth):
+    """ S3 SigV4 signer that reuses the derived signing key and HMAC objects across requests """
+    def _sign(self, key, msg, hex=False):
+        return sign(key, msg, hex=hex)
+
+    @staticmethod
+    def _default_headers(request):
+        # only host, X-Amz-Date and X-Amz-Content-SHA256 are set and there
+        # is no query string to canonicalize
+        names = {name.lower() for name in request.headers.keys()}
+        return (names == _DEFAULT_HEADER_NAMES
+                and not urlsplit(request.url).query)
+
+    def canonical_request(self, request):
+        if not self._default_headers(request):
+            return super().canonical_request(request)
+        # the header set is fixed, so build the canonical request directly
+        # rather than collecting and sorting the headers
+        headers = request.headers
+        path = urlsplit(request.url).path
+        return (f"{request.method.upper()}\n{path}\n\n"
+                f"host:{headers['host']}\n"
+                f"x-amz-content-sha256:{headers['X-Amz-Content-SHA256']}\n"
+                f"x-amz-date:{headers['X-Amz-Date']}\n\n"
+                f"{_DEFAULT_SIGNED_HEADERS}\n"
+                f"{headers['X-Amz-Content-SHA256']}")
+
+    def _inject_signature_to_request(self, request, signature):
+        if not self._default_headers(request):
+            return super()._inject_signature_to_request(request, signature)
+        request.headers['Authorization'] = (
+            f"AWS4-HMAC-SHA256 Credential={self.scope(request)}, "
+            f"SignedHeaders={_DEFAULT_SIGNED_HEADERS}, Signature={signature}")
+        return request
+
+    def signature(self, string_to_sign, request):
+        signing_key = getSignatureKey(self.credentials.secret_key,
+                                      request.context['timestamp'][0:8],
+                                      self._region_name, self._service_name)
+        return self._sign(signing_key, string_to_sign, hex=True)
+
+
 def get_presigned_url(url,
                       aws_region=None,
                       rtype='GET',
@@ -452,62 +994,29 @@ def get_presigned_url(url,
 
     service = 's3'
     host = '%s.%s.amazonaws.com' % (bucket, service)
-    request_parameters = ''
-
-    # Key derivation functions. See:
-    # http://docs.aws.amazon.com/general/latest/gr/signature-v4-examples.html#signature-v4-examples-python
-    def sign(key, msg):
-        return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
-
-    def getSignatureKey(key, dateStamp, regionName, serviceName):
-        kDate = sign(('AWS4' + key).encode('utf-8'), dateStamp)
-        kRegion = sign(kDate, regionName)
-        kService = sign(kRegion, serviceName)
-        kSigning = sign(kService, 'aws4_request')
-        return kSigning
-
-    # Create a date for headers and the credential string
-    t = datetime.utcnow()
-    amzdate = t.strftime('%Y%m%dT%H%M%SZ')
-    datestamp = t.strftime('%Y%m%d')  # Date w/o time, used in credential scope
-
-    # create signed request and headers
-    canonical_uri = '/' + key
-    canonical_querystring = request_parameters
-
-    payload_hash = 'UNSIGNED-PAYLOAD'
-    headers = {
-        'host': host,
-        'x-amz-content-sha256': payload_hash,
-        'x-amz-date': amzdate
-    }
+    request_url = 'https://%s/%s' % (host, quote(key, safe='/~'))
 
+    headers = {'host': host}
     if requester_pays:
         headers['x-amz-request-payer'] = 'requester'
     if public:
         headers['x-amz-acl'] = 'public-read'
+    token = None
     if os.environ.get('AWS_SESSION_TOKEN'
                       ) and 'AWS_BUCKET_ACCESS_KEY_ID' not in os.environ:
-        headers['x-amz-security-token'] = os.environ.get('AWS_SESSION_TOKEN')
-    canonical_headers = '\n'.join('%s:%s' % (key, headers[key])
-                                  for key in sorted(headers)) + '\n'
-    signed_headers = ';'.join(sorted(headers.keys()))
-
-    canonical_request = '%s\n%s\n%s\n%s\n%s\n%s' % (
-        rtype, canonical_uri, canonical_querystring, canonical_headers,
-        signed_headers, payload_hash)
-    algorithm = 'AWS4-HMAC-SHA256'
-    credential_scope = datestamp + '/' + region + '/' + service + '/' + 'aws4_request'
-    string_to_sign = algorithm + '\n' + amzdate + '\n' + credential_scope + '\n' + \
-        hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
-    signing_key = getSignatureKey(secret_key, datestamp, region, service)
-    signature = hmac.new(signing_key, string_to_sign.encode('utf-8'),
-                         hashlib.sha256).hexdigest()
-    authorization_header = algorithm + ' ' + 'Credential=' + access_key + '/' + credential_scope + ', ' \
-        + 'SignedHeaders=' + signed_headers + ', ' + 'Signature=' + signature
-
-    request_url = 'https://%s%s' % (host, canonical_uri)
-    headers['Authorization'] = authorization_header
+        token = os.environ.get('AWS_SESSION_TOKEN')
+
+    # sign the request headers with botocore's SigV4 signer
+    request = AWSRequest(method=rtype, url=request_url, headers=headers)
+    request.context['client_config'] = _UNSIGNED_PAYLOAD_CFG
+    credentials = Credentials(access_key, secret_key, token)
+    _S3SigV4Auth(credentials, service, region).add_auth(request)
+
+    headers = {
+        k.lower(): v
+        for k, v in request.headers.items() if k != 'Authorization'
+    }
+    headers['Authorization'] = request.headers['Authorization']
     if content_type is not None:
         headers['content-type'] = content_type
     return request_url, headers
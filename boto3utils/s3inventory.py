@@ -47,9 +47,9 @@ class S3Inventory(object):
         logger.info(f"Reading manifest file {href}")
 
         # get manifest file for date, default to latest
+        prefix = parts['key'].rstrip('/') + '/' if parts['key'] else ''
         for dt in [date - timedelta(x) for x in range(max_age)]:
-            _key = Path(parts['key']) / dt.strftime('%Y-%m-%d')
-            _href = 's3://%s/%s' % (parts['bucket'], _key)
+            _href = f"s3://{parts['bucket']}/{prefix}{dt:%Y-%m-%d}"
             manifests = [
                 k for k in s3client.find(_href, suffix='manifest.json')
             ]
@@ -66,7 +66,7 @@ class S3Inventory(object):
         numfiles = len(files)
         logger.info(f"{numfiles} inventory files")
 
-        return ['s3://%s/%s' % (bucket, f['key']) for f in files]
+        return [f"s3://{bucket}/{f['key']}" for f in files]
 
     @classmethod
     def read_inventory_file(cls,
@@ -75,10 +75,7 @@ class S3Inventory(object):
                             s3client: Optional["s3"] = None):
         logger.debug('Reading inventory file %s' % (fname))
 
-        inv = [{
-            schema[i]: v
-            for i, v in enumerate(line.replace('"', '').split(','))
-        } for line in s3client.read(fname).split('\n')]
+        inv = [dict(zip(schema, row)) for row in s3client.read_csv(fname)]
 
         return inv
 
@@ -108,57 +105,21 @@ class S3Inventory(object):
                               key_contains=None,
                               datetime_key='LastModifiedDate',
                               s3client: "s3" = s3()):
-        inv = cls.read_inventory_file(fname, schema, s3client=s3client)
-
-        def fvalid(info):
-            return True if 'Key' in info and 'Bucket' in info else False
-
-        def fprefix(info):
-            return True if info['Key'][:len(prefix)] == prefix else False
-
-        def fsuffix(info):
-            return True if info['Key'].endswith(suffix) else False
-
-        def fstartdate(info):
-            dt = datetime.strptime(info[datetime_key],
-                                   "%Y-%m-%dT%H:%M:%S.%fZ").date()
-            return True if dt > start_date else False
-
-        def fenddate(info):
-            dt = datetime.strptime(info[datetime_key],
-                                   "%Y-%m-%dT%H:%M:%S.%fZ").date()
-            return True if dt < end_date else False
-
-        def islatest(info):
-            latest = info.get("IsLatest")
-            if latest:
-                return latest not in ("false", False)
-            return True
-
-        def fcontains(info):
-            for part in key_contains:
-                if part not in info["Key"]:
-                    return False
-            return True
-
-        inv = filter(fvalid, inv)
-
-        if is_latest is not None:
-            inv = filter(islatest, inv)
-        if key_contains:
-            inv = filter(fcontains, inv)
-        if prefix:
-            inv = filter(fprefix, inv)
-        if suffix:
-            inv = filter(fsuffix, inv)
-        if start_date:
-            inv = filter(fstartdate, inv)
-        if end_date:
-            inv = filter(fenddate, inv)
+        # rows are filtered by position in the schema, comparing dates as
+        # ISO 8601 strings rather than parsing them
+        inv = s3client.read_inventory_file(fname,
+                                           schema,
+                                           prefix=prefix,
+                                           suffix=suffix,
+                                           start_date=start_date,
+                                           end_date=end_date,
+                                           is_latest=is_latest,
+                                           key_contains=key_contains,
+                                           datetime_key=datetime_key)
 
         _i = -1
-        for _i, i in enumerate(inv):
-            yield 's3://%s/%s' % (i['Bucket'], i['Key'])
+        for _i, url in enumerate(inv):
+            yield url
         logger.info(f"Matched {_i+1} files")
 
     def latest_inventory_files(self, url, manifest=None):
@@ -173,7 +134,7 @@ class S3Inventory(object):
                         (url, numfiles))
 
             for f in files:
-                _url = 's3://%s/%s' % (bucket, f['key'])
+                _url = f"s3://{bucket}/{f['key']}"
                 yield _url
 
     def latest_inventory(self, url, **kwargs):
@@ -1,8 +1,19 @@
 import boto3
+import botocore.auth
+import botocore.awsrequest
+import botocore.credentials
+import hashlib
+import hmac
+import json
 import os
 import pytest
+import sys
 
 from boto3utils import s3
+from botocore.config import Config
+from boto3utils.s3 import get_presigned_url, getSignatureKey, sign
+from datetime import date, datetime
+from gzip import compress
 from shutil import rmtree
 
 BUCKET = 'testbucket'
@@ -66,6 +77,22 @@ def test_urlparse_nokey():
     assert (parts['parameters'] == {})
 
 
+def test_urlparse_prefix():
+    parts = s3.urlparse('s3://bucket/prefix/path/file.json')
+    assert (parts['bucket'] == 'bucket')
+    assert (parts['key'] == 'prefix/path/file.json')
+    assert (parts['filename'] == 'file.json')
+    assert (parts['parameters'] == {})
+
+
+def test_urlparse_https():
+    parts = s3.urlparse(
+        'https://bucket.s3.us-west-2.amazonaws.com/prefix/filename')
+    assert (parts['bucket'] == 'bucket')
+    assert (parts['key'] == 'prefix/filename')
+    assert (parts['filename'] == 'filename')
+
+
 def test_urlparse_invalid():
     with pytest.raises(Exception):
         s3.urlparse('invalid')
@@ -77,6 +104,40 @@ def test_s3_to_https():
     assert (url == 'https://bucket.s3.us-west-2.amazonaws.com/prefix/filename')
 
 
+def test_client_lazy(s3mock):
+    _s3 = s3()
+    assert (_s3._client is None)
+    assert (_s3.s3 is _s3.s3)
+    assert (_s3.s3.meta.config.max_pool_connections == 50)
+    assert (_s3.s3.meta.config.retries['mode'] == 'adaptive')
+
+
+def test_client_config(s3mock, monkeypatch):
+    module = sys.modules['boto3utils.s3']
+    monkeypatch.setattr(module, '_CLIENT_CONFIG', module._CLIENT_CONFIG)
+    module.set_client_config(max_pool_connections=100)
+    assert (s3().s3.meta.config.max_pool_connections == 100)
+    _s3 = s3(config=Config(max_pool_connections=5))
+    assert (_s3.s3.meta.config.max_pool_connections == 5)
+    assert (_s3.s3.meta.config.tcp_keepalive)
+
+
+def test_client_assign(s3mock):
+    calls = []
+    _head = s3mock.head_object
+
+    def head_object(**kwargs):
+        calls.append(kwargs)
+        return _head(**kwargs)
+
+    s3mock.head_object = head_object
+    _s3 = s3()
+    _s3.s3 = s3mock
+    assert (_s3.s3 is s3mock)
+    assert (_s3.exists('s3://%s/%s' % (BUCKET, KEY)))
+    assert (calls == [{'Bucket': BUCKET, 'Key': KEY}])
+
+
 def test_get_bucket_region_null(s3mock):
     region = s3().get_bucket_region(BUCKET)
     assert region == 'us-east-1'
@@ -94,6 +155,42 @@ def test_exists(s3mock):
     assert (exists)
 
 
+def test_exists_many(s3mock):
+    for i in range(3):
+        s3mock.put_object(Body='', Bucket=BUCKET, Key='many/%s.json' % i)
+    urls = ['s3://%s/many/%s.json' % (BUCKET, i) for i in range(5)]
+    assert (s3().exists_many(urls) == {
+        url: i < 3
+        for i, url in enumerate(urls)
+    })
+    # no common prefix
+    urls = ['s3://%s/%s' % (BUCKET, KEY), 's3://%s/keymaster' % BUCKET]
+    assert (s3().exists_many(urls) == {urls[0]: True, urls[1]: False})
+
+
+def test_exists_many_start_after(s3mock):
+    for i in range(5):
+        s3mock.put_object(Body='', Bucket=BUCKET, Key='many/%s.json' % i)
+    _s3 = s3()
+    _list = _s3.s3.list_objects_v2
+    calls = []
+
+    def list_objects_v2(**kwargs):
+        resp = _list(**dict(kwargs, MaxKeys=1))
+        calls.append(resp['Contents'][0]['Key'])
+        return resp
+
+    _s3.s3.list_objects_v2 = list_objects_v2
+    urls = ['s3://%s/many/%s.json' % (BUCKET, i) for i in [3, 2, 9]]
+    assert (_s3.exists_many(urls) == {
+        urls[0]: True,
+        urls[1]: True,
+        urls[2]: False
+    })
+    # listing starts at the first key checked
+    assert (calls == ['many/2.json', 'many/3.json', 'many/4.json'])
+
+
 def test_exists_invalid():
     with pytest.raises(Exception):
         s3().exists('invalid')
@@ -111,6 +208,54 @@ def test_upload_download(s3mock):
     rmtree(path)
 
 
+def test_upload_public_extra(s3mock):
+    extra = {'ContentType': 'text/plain'}
+    url = 's3://%s/mytestfile' % BUCKET
+    s3().upload(__file__, url, public=True, extra=extra)
+    assert (extra == {'ContentType': 'text/plain'})
+    obj = s3mock.get_object(Bucket=BUCKET, Key='mytestfile')
+    assert (obj['ContentType'] == 'text/plain')
+
+
+def test_upload_gzip(s3mock):
+    url = 's3://%s/test.json' % BUCKET
+    url_out = s3().upload(os.path.join(testpath, 'test.json'),
+                          url,
+                          gzip_if=lambda f: f.endswith('.json'))
+    assert (url_out == url + '.gz')
+    obj = s3mock.get_object(Bucket=BUCKET, Key='test.json.gz')
+    assert (obj['ContentEncoding'].startswith('gzip'))
+    assert (s3().read_json(url_out)['field'] == 'value')
+    # not compressed if the predicate is false
+    url = 's3://%s/test_s3.py' % BUCKET
+    assert (s3().upload(__file__, url,
+                        gzip_if=lambda f: f.endswith('.json')) == url)
+
+
+def test_upload_download_max_concurrency(s3mock):
+    url = 's3://%s/mytestfile' % BUCKET
+    s3().upload(__file__, url, max_concurrency=2)
+    path = os.path.join(testpath,
+                        'test_s3/test_upload_download_max_concurrency')
+    fname = s3().download(url, path, max_concurrency=2)
+    with open(fname) as f1, open(__file__) as f2:
+        assert (f1.read() == f2.read())
+    rmtree(path)
+
+
+def test_download_many(s3mock):
+    urls = ['s3://%s/%s' % (BUCKET, KEY), 's3://%s/test.json' % BUCKET]
+    path = os.path.join(testpath, 'test_s3/test_download_many')
+    fnames = s3().download_many(urls, path, max_workers=2)
+    assert (fnames == [
+        os.path.join(path, KEY),
+        os.path.join(path, 'test.json')
+    ])
+    for fname in fnames:
+        assert (os.path.exists(fname))
+    rmtree(path)
+
+
 def test_upload_getobject(s3mock):
     # upload the object
     url = 's3://%s/mytestfile' % BUCKET
@@ -153,6 +298,184 @@ def test_read_json(s3mock):
     assert (out['field'] == 'value')
 
 
+def test_read_many(s3mock):
+    urls = ['s3://%s/%s' % (BUCKET, KEY), 's3://%s/test.json' % BUCKET]
+    out = s3().read_many(urls + urls, max_workers=2)
+    assert (len(out) == 4)
+    assert (out[0] == out[2] == 'helloworld')
+    assert (out[1] == out[3])
+    assert ('"field"' in out[1])
+
+
+INVENTORY_SCHEMA = ['Bucket', 'Key', 'Size', 'LastModifiedDate']
+INVENTORY = [
+    ['testbucket', 'a/1.json', '10', '2022-10-01T01:02:03.000Z'],
+    ['testbucket', 'a/2.txt', '20', '2022-10-02T01:02:03.000Z'],
+    ['testbucket', 'b/3,4.json', '30', '2022-10-03T01:02:03.000Z'],
+    ['testbucket', 'a/5.json', '40', '2022-10-04T01:02:03.000Z'],
+]
+
+
+def put_inventory_file(s3mock, key='inventory/data.csv.gz'):
+    lines = ['"%s"' % '","'.join(row) for row in INVENTORY]
+    body = compress(('\n'.join(lines) + '\n').encode('utf-8'))
+    s3mock.put_object(Body=body, Bucket=BUCKET, Key=key)
+    return 's3://%s/%s' % (BUCKET, key)
+
+
+def test_read_csv(s3mock):
+    url = put_inventory_file(s3mock)
+    assert (list(s3().read_csv(url)) == INVENTORY)
+
+
+def test_read_gz(s3mock):
+    s3mock.put_object(Body=compress(b'line1\nline2\n'),
+                      Bucket=BUCKET,
+                      Key='lines.txt.gz')
+    url = 's3://%s/lines.txt.gz' % BUCKET
+    assert (s3().read(url) == 'line1\nline2\n')
+    assert (list(s3().iter_lines(url)) == ['line1', 'line2'])
+
+
+def test_iter_lines_closes_body(s3mock):
+    s3mock.put_object(Body=compress(b'line1\nline2\n'),
+                      Bucket=BUCKET,
+                      Key='lines.txt.gz')
+    _s3 = s3()
+    closed = []
+    _get_object = _s3.get_object
+
+    def get_object(*args, **kwargs):
+        response = _get_object(*args, **kwargs)
+        _close = response['Body'].close
+
+        def close():
+            closed.append(True)
+            _close()
+
+        response['Body'].close = close
+        return response
+
+    _s3.get_object = get_object
+    lines = _s3.iter_lines('s3://%s/lines.txt.gz' % BUCKET)
+    for line in lines:
+        break
+    lines.close()
+    assert (closed)
+
+
+def test_read_inventory_file(s3mock):
+    url = put_inventory_file(s3mock)
+    urls = list(s3().read_inventory_file(url, INVENTORY_SCHEMA))
+    assert (urls == ['s3://testbucket/%s' % row[1] for row in INVENTORY])
+    urls = list(s3().read_inventory_file(url,
+                                         INVENTORY_SCHEMA,
+                                         prefix='a/',
+                                         suffix='.json',
+                                         start_date=date(2022, 10, 1),
+                                         end_date=date(2022, 10, 5)))
+    assert (urls == ['s3://testbucket/a/5.json'])
+
+
+def test_read_json_no_orjson(s3mock, monkeypatch):
+    monkeypatch.setattr(sys.modules['boto3utils.s3'], 'orjson', None)
+    url = 's3://%s/test.json' % BUCKET
+    out = s3().read_json(url)
+    assert (out['field'] == 'value')
+
+
+def test_read_inventory_file_filters(s3mock):
+    lines = [
+        'testbucket,a/1.json,true', 'testbucket,a/1.json,false',
+        'testbucket,b/2.json,true', 'testbucket', ''
+    ]
+    s3mock.put_object(Body='\n'.join(lines),
+                      Bucket=BUCKET,
+                      Key='inventory/versions.csv')
+    url = 's3://%s/inventory/versions.csv' % BUCKET
+    schema = ['Bucket', 'Key', 'IsLatest']
+    urls = list(s3().read_inventory_file(url, schema))
+    assert (urls == [
+        's3://testbucket/a/1.json', 's3://testbucket/a/1.json',
+        's3://testbucket/b/2.json'
+    ])
+    urls = list(s3().read_inventory_file(url, schema, is_latest=True))
+    assert (urls == ['s3://testbucket/a/1.json', 's3://testbucket/b/2.json'])
+    urls = list(s3().read_inventory_file(url,
+                                         schema,
+                                         is_latest=True,
+                                         key_contains=['b/', '.json']))
+    assert (urls == ['s3://testbucket/b/2.json'])
+    lines = ['b,k1,2020-01-01T00:00:00.000Z', 'b,k2']
+    s3mock.put_object(Body='\n'.join(lines),
+                      Bucket=BUCKET,
+                      Key='inventory/dates.csv')
+    url = 's3://%s/inventory/dates.csv' % BUCKET
+    schema = ['Bucket', 'Key', 'LastModifiedDate']
+    urls = list(s3().read_inventory_file(url,
+                                         schema,
+                                         start_date=date(2019, 12, 31)))
+    assert (urls == ['s3://b/k1'])
+
+
+def test_inventory_select_expression():
+    module = sys.modules['boto3utils.s3']
+    sql = module._inventory_select_expression(INVENTORY_SCHEMA)
+    assert (sql == 'SELECT s._1, s._2 FROM S3Object s')
+    sql = module._inventory_select_expression(INVENTORY_SCHEMA,
+                                              prefix="a_b/it's",
+                                              suffix='.json',
+                                              start_date=date(2022, 10, 1))
+    assert (sql == 'SELECT s._1, s._2 FROM S3Object s WHERE '
+            "s._2 LIKE 'a\\_b/it''s%' ESCAPE '\\' AND "
+            "s._2 LIKE '%.json' ESCAPE '\\' AND "
+            "SUBSTRING(s._4, 1, 10) > '2022-10-01'")
+
+
+def test_select_inventory_file(s3mock):
+    calls = []
+
+    def select_object_content(**kwargs):
+        calls.append(kwargs)
+        # records split mid-line across events
+        return {
+            'Payload': [{
+                'Records': {
+                    'Payload': b'testbucket,a/1.json\ntestbu'
+                }
+            }, {
+                'Stats': {}
+            }, {
+                'Records': {
+                    'Payload': b'cket,"b/3,4.json"\n'
+                }
+            }, {
+                'End': {}
+            }]
+        }
+
+    _s3 = s3()
+    _s3.s3.select_object_content = select_object_content
+    url = 's3://%s/inventory/data.csv.gz' % BUCKET
+    urls = list(
+        _s3.select_inventory_file(url, INVENTORY_SCHEMA, suffix='.json'))
+    assert (urls == ['s3://testbucket/a/1.json', 's3://testbucket/b/3,4.json'])
+    assert (calls[0]['Key'] == 'inventory/data.csv.gz')
+    assert (calls[0]['InputSerialization']['CompressionType'] == 'GZIP')
+
+
+def test_prefetch(s3mock):
+    urls = []
+    for i in range(5):
+        s3mock.put_object(Body=compress(str(i).encode('utf-8')),
+                          Bucket=BUCKET,
+                          Key='prefetch/%s.gz' % i)
+        urls.append('s3://%s/prefetch/%s.gz' % (BUCKET, i))
+    out = [(url, f.read()) for url, f in s3().prefetch(urls, max_workers=2)]
+    assert (out == [(url, str(i).encode('utf-8'))
+                    for i, url in enumerate(urls)])
+
+
 def test_delete(s3mock):
     url = 's3://%s/test.json' % BUCKET
     out = s3().delete(url)
@@ -166,6 +489,174 @@ def test_find(s3mock):
     assert (url + '.json' in urls)
 
 
+def test_find_start_after(s3mock):
+    for i in range(5):
+        s3mock.put_object(Body='', Bucket=BUCKET, Key='after/%s.json' % i)
+    url = 's3://%s/after/' % BUCKET
+    urls = list(s3().find(url, suffix='.json', start_after='after/2.json'))
+    assert (urls == [url + '3.json', url + '4.json'])
+
+
+def test_find_read_ahead(s3mock):
+    for i in range(5):
+        s3mock.put_object(Body='', Bucket=BUCKET, Key='pages/%s' % i)
+    s3mock.put_object(Body='', Bucket=BUCKET, Key='other')
+    _s3 = s3()
+    # force a page per object
+    _list = _s3.s3.list_objects_v2
+    _s3.s3.list_objects_v2 = lambda **kwargs: _list(**dict(kwargs, MaxKeys=1))
+    url = 's3://%s/pages/' % BUCKET
+    urls = list(_s3.find(url, read_ahead=True))
+    assert (urls == [url + str(i) for i in range(5)])
+
+
+def test_find_parallel(s3mock):
+    keys = ['a/1.json', 'a/2.txt', 'b/c/3.json', 'd/4.json', '5.json']
+    for key in keys:
+        s3mock.put_object(Body='', Bucket=BUCKET, Key='parallel/%s' % key)
+    url = 's3://%s/parallel/' % BUCKET
+    urls = list(s3().find_parallel(url, suffix='.json', max_workers=2))
+    assert (sorted(urls) == sorted(
+        [url + k for k in keys if k.endswith('.json')]))
+
+
+def test_find_parallel_shards(s3mock):
+    keys = ['0abc', '0def', '1abc', 'fabc', 'zabc']
+    for key in keys:
+        s3mock.put_object(Body='', Bucket=BUCKET, Key='sharded/%s' % key)
+    url = 's3://%s/sharded/' % BUCKET
+    urls = list(s3().find_parallel(url, shards='0123456789abcdef'))
+    assert (sorted(urls) == [url + k for k in keys[:4]])
+
+
+def test_get_presigned_url(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'AKID')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'secret')
+    monkeypatch.delenv('AWS_SESSION_TOKEN', raising=False)
+    monkeypatch.setattr(botocore.auth, 'get_current_datetime',
+                        lambda: datetime(2024, 1, 2, 3, 4, 5))
+    url, headers = get_presigned_url('s3://bucket/a/b.json',
+                                     aws_region='us-west-2')
+    assert (url == 'https://bucket.s3.amazonaws.com/a/b.json')
+    assert (headers['host'] == 'bucket.s3.amazonaws.com')
+    assert (headers['x-amz-content-sha256'] == 'UNSIGNED-PAYLOAD')
+    assert (headers['x-amz-date'] == '20240102T030405Z')
+    assert (headers['Authorization'] == (
+        'AWS4-HMAC-SHA256 Credential=AKID/20240102/us-west-2/s3/aws4_request, '
+        'SignedHeaders=host;x-amz-content-sha256;x-amz-date, '
+        'Signature=4669b180beab02b944815ddf9c760e8e3319144a343e978d2c0d6d8248463852'
+    ))
+
+
+def test_get_presigned_url_method_case(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'AKID')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'secret')
+    monkeypatch.delenv('AWS_SESSION_TOKEN', raising=False)
+    monkeypatch.setattr(botocore.auth, 'get_current_datetime',
+                        lambda: datetime(2024, 1, 2, 3, 4, 5))
+    _, headers1 = get_presigned_url('s3://bucket/a/b.json', rtype='get')
+    _, headers2 = get_presigned_url('s3://bucket/a/b.json', rtype='GET')
+    assert (headers1['Authorization'] == headers2['Authorization'])
+
+
+def test_signer_matches_botocore(monkeypatch):
+    monkeypatch.setattr(botocore.auth, 'get_current_datetime',
+                        lambda: datetime(2024, 1, 2, 3, 4, 5))
+    module = sys.modules['boto3utils.s3']
+    credentials = botocore.credentials.Credentials('AKID', 'secret')
+    url = 'https://bucket.s3.amazonaws.com/a/b.json'
+    # three headers, but not the default ones, and a query string
+    for headers, query in [({
+            'x-amz-acl': 'public-read'
+    }, ''), ({
+            'host': 'bucket.s3.amazonaws.com'
+    }, '?versionId=1')]:
+        signed = []
+        for signer in [module._S3SigV4Auth, botocore.auth.S3SigV4Auth]:
+            request = botocore.awsrequest.AWSRequest(method='GET',
+                                                     url=url + query,
+                                                     headers=dict(headers))
+            request.context['client_config'] = module._UNSIGNED_PAYLOAD_CFG
+            signer(credentials, 's3', 'us-west-2').add_auth(request)
+            signed.append(request.headers['Authorization'])
+        assert (signed[0] == signed[1])
+
+
+def test_get_presigned_url_headers(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'AKID')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'secret')
+    monkeypatch.delenv('AWS_SESSION_TOKEN', raising=False)
+    monkeypatch.setattr(botocore.auth, 'get_current_datetime',
+                        lambda: datetime(2024, 1, 2, 3, 4, 5))
+    _, headers = get_presigned_url('s3://bucket/a/b.json',
+                                   aws_region='us-west-2',
+                                   rtype='PUT',
+                                   public=True,
+                                   requester_pays=True,
+                                   content_type='application/json')
+    assert (headers['x-amz-acl'] == 'public-read')
+    assert (headers['x-amz-request-payer'] == 'requester')
+    assert (headers['content-type'] == 'application/json')
+    assert (headers['Authorization'] == (
+        'AWS4-HMAC-SHA256 Credential=AKID/20240102/us-west-2/s3/aws4_request, '
+        'SignedHeaders=host;x-amz-acl;x-amz-content-sha256;x-amz-date;x-amz-request-payer, '
+        'Signature=f7021c8590abf622115797393c1f821c8bfa550e693c791b734c7e98ae9a0df3'
+    ))
+
+
+def test_get_presigned_url_cached_key(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'AKID')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'secret')
+    monkeypatch.delenv('AWS_SESSION_TOKEN', raising=False)
+    monkeypatch.setattr(botocore.auth, 'get_current_datetime',
+                        lambda: datetime(2024, 1, 2, 3, 4, 5))
+    getSignatureKey.cache_clear()
+    _, headers1 = get_presigned_url('s3://bucket/a/1.json')
+    _, headers2 = get_presigned_url('s3://bucket/a/2.json')
+    assert (headers1['Authorization'] != headers2['Authorization'])
+    info = getSignatureKey.cache_info()
+    assert (info.misses == 1 and info.hits == 1)
+
+
+def test_sign():
+    key = b'key'
+    for msg in ['message1', 'message2']:
+        expected = hmac.new(key, msg.encode('utf-8'), hashlib.sha256)
+        assert (sign(key, msg) == expected.digest())
+        assert (sign(key, msg, hex=True) == expected.hexdigest())
+
+
+def test_get_presigned_url_nocreds(monkeypatch):
+    monkeypatch.delenv('AWS_ACCESS_KEY_ID', raising=False)
+    monkeypatch.delenv('AWS_SECRET_ACCESS_KEY', raising=False)
+    url = 's3://bucket/a/b.json'
+    assert (get_presigned_url(url) == (url, None))
+
+
+def test_latest_inventory_prefetch(s3mock):
+    keys = ['inventory/data%s.csv.gz' % i for i in range(3)]
+    for key in keys:
+        put_inventory_file(s3mock, key)
+    manifest = {
+        'fileSchema': ', '.join(INVENTORY_SCHEMA),
+        'files': [{
+            'key': key
+        } for key in keys]
+    }
+    manifest_key = 'inventory/%s/manifest.json' % datetime.now().strftime(
+        '%Y-%m-%d')
+    s3mock.put_object(Body=json.dumps(manifest),
+                      Bucket=BUCKET,
+                      Key=manifest_key)
+    urls = list(s3().latest_inventory('s3://%s/inventory' % BUCKET,
+                                      suffix='.json',
+                                      max_workers=2))
+    assert (urls == [
+        's3://testbucket/a/1.json', 's3://testbucket/b/3,4.json',
+        's3://testbucket/a/5.json'
+    ] * 3)
+
+
 def test_latest_inventory():
     from botocore.handlers import disable_signing
 
@@ -1,8 +1,13 @@
+import json
 import pytest
 
+from boto3utils import s3 as s3client
 from boto3utils.s3inventory import S3Inventory
+from datetime import date, datetime
 
 DATE = '2022-10-31'
+BUCKET = 'testbucket'
+SCHEMA = ['Bucket', 'Key', 'Size', 'LastModifiedDate']
 
 
 @pytest.fixture
@@ -23,3 +28,36 @@ def _test_init_s3inventory(test_inventory):
 def _test_inventory_files(test_inventory):
     filenames = test_inventory.inventory_file_hrefs()
     assert (len(filenames) == 1258)
+
+
+def test_filter_inventory_file(s3):
+    s3.create_bucket(Bucket=BUCKET)
+    lines = [
+        'testbucket,a/1.json,10,2022-10-01T01:02:03.000Z',
+        'testbucket,a/2.txt,20,2022-10-02T01:02:03.000Z',
+        'testbucket,a/3.json,30,2022-10-03T01:02:03.000Z',
+    ]
+    s3.put_object(Body='\n'.join(lines), Bucket=BUCKET, Key='inventory.csv')
+    fname = 's3://%s/inventory.csv' % BUCKET
+    urls = list(
+        S3Inventory.filter_inventory_file(fname,
+                                          SCHEMA,
+                                          suffix='.json',
+                                          start_date=date(2022, 10, 1),
+                                          s3client=s3client()))
+    assert (urls == ['s3://testbucket/a/3.json'])
+
+
+def test_read_manifest(s3):
+    s3.create_bucket(Bucket=BUCKET)
+    manifest = {'fileSchema': ', '.join(SCHEMA), 'files': []}
+    s3.put_object(Body=json.dumps(manifest),
+                  Bucket=BUCKET,
+                  Key='inventory/%sT01-00Z/manifest.json' % DATE)
+    for href in ['s3://%s/inventory' % BUCKET, 's3://%s/inventory/' % BUCKET]:
+        out = S3Inventory.read_manifest(href,
+                                        datetime(2022, 11, 1),
+                                        max_age=2,
+                                        s3client=s3client())
+        assert (out['datetime'] == '%sT01-00Z' % DATE)
+        assert (out['fileSchema'] == manifest['fileSchema'])